@@ -0,0 +1,129 @@
+# Middleware benchmark
+# python bench_middleware.py
+"""
+Calls a tiny app through each middleware layer directly (no server, no network),
+so the numbers are only the cost that the layer adds to one request.
+The last cases run "/" through the real main.app, with and without all of its middleware.
+"""
+import asyncio
+from time import perf_counter
+from uuid import uuid4
+
+from fastapi import Request
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import PlainTextResponse
+
+from main import app as main_app
+from main import (
+    ADMIN_KEY,
+    ADMIN_TOKEN,
+    SESSION_COOKIE,
+    SESSION_SECRET_KEY,
+    CachedCORSMiddleware,
+    LRUSessionBackend,
+    ProcessTimeMiddleware,
+    ServerSessionMiddleware,
+    TraceMiddleware,
+    origins,
+)
+
+REQUESTS = 20_000
+
+
+async def endpoint(scope, receive, send):
+    await PlainTextResponse("OK")(scope, receive, send)
+
+
+async def write_session(scope, receive, send):
+    scope["session"]["visits"] = scope["session"].get("visits", 0) + 1
+    await endpoint(scope, receive, send)
+
+
+async def add_process_time_header(request: Request, call_next):
+    start_time = perf_counter()
+    response = await call_next(request)
+    response.headers["X-Process-Time"] = str(perf_counter() - start_time)
+    return response
+
+
+def make_scope(method="GET", headers=(), path="/"):
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(k.encode(), v.encode()) for k, v in headers],
+        "client": ("127.0.0.1", 1234),
+        "server": ("127.0.0.1", 8000),
+    }
+
+
+def make_receive():
+    messages = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.Event().wait()  # the client never disconnects
+
+    return receive
+
+
+async def send(message):
+    pass
+
+
+async def run(app, scope):
+    start = perf_counter()
+    for _ in range(REQUESTS):
+        await app(dict(scope), make_receive(), send)
+    return (perf_counter() - start) / REQUESTS * 1_000_000
+
+
+async def main():
+    cors_options = dict(allow_origins=origins, allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+    get = make_scope()
+    cors_get = make_scope(headers=[("origin", "http://localhost")])
+    admin = [("x-trace", "1"), ("x-token", ADMIN_TOKEN), ("x-key", ADMIN_KEY)]
+
+    backend = LRUSessionBackend()
+    session_layer = ServerSessionMiddleware(endpoint, backend=backend, secret_key=SESSION_SECRET_KEY)
+    session_id = uuid4()
+    await backend.create(session_id, {"last_query": "rock"})
+    session_get = make_scope(headers=[("cookie", f"{SESSION_COOKIE}={session_layer.signer.dumps(session_id.hex)}")])
+    preflight = make_scope("OPTIONS", [("origin", "http://localhost"), ("access-control-request-method", "PUT"), ("access-control-request-headers", "x-token")])
+
+    cases = [
+        ("endpoint only", endpoint, get),
+        ("BaseHTTPMiddleware timing", BaseHTTPMiddleware(endpoint, dispatch=add_process_time_header), get),
+        ("ProcessTimeMiddleware", ProcessTimeMiddleware(endpoint), get),
+        ("CORS simple request", CachedCORSMiddleware(endpoint, **cors_options), cors_get),
+        ("CORS preflight (cached)", CachedCORSMiddleware(endpoint, **cors_options), preflight),
+        ("CORS + timing", CachedCORSMiddleware(ProcessTimeMiddleware(endpoint), **cors_options), cors_get),
+        ("session, no cookie", session_layer, get),
+        ("session, read", session_layer, session_get),
+        ("session, write", ServerSessionMiddleware(write_session, backend=backend, secret_key=SESSION_SECRET_KEY), session_get),
+        ("trace, not traced", TraceMiddleware(endpoint), get),
+        ("trace, traced", TraceMiddleware(endpoint), make_scope(headers=admin)),
+        ("main.app router only", main_app.router, get),
+        ("main.app full stack", main_app, get),
+        ("main.app full stack, CORS", main_app, cors_get),
+        ("main.app full stack, traced", main_app, make_scope(headers=admin)),
+    ]
+
+    baseline = None
+    for name, app, scope in cases:
+        await run(app, scope)  # warm up
+        per_request = await run(app, scope)
+        if baseline is None:
+            baseline = per_request
+        print(f"{name:<28} {per_request:8.2f} us/request  (+{per_request - baseline:6.2f} us)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
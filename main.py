@@ -1,8 +1,17 @@
 from fastapi import FastAPI, Query, Path, Body, Cookie, Header, Response, status, Form, File, UploadFile, HTTPException, Depends, Request, BackgroundTasks, WebSocket
-from fastapi.responses import JSONResponse, RedirectResponse, HTMLResponse, ORJSONResponse
+from fastapi.responses import JSONResponse, RedirectResponse, HTMLResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+import asyncio
+from bisect import bisect_right
+import sys
+import csv
+import io
+import json
+import re
+import zlib
 from enum import Enum
-from pydantic import BaseModel, Field, HttpUrl, EmailStr
+from pydantic import BaseModel, Field, HttpUrl, EmailStr, ValidationError
 from typing import Annotated, Any
 from datetime import datetime, time, timedelta
 from uuid import UUID
@@ -10,9 +19,15 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.staticfiles import StaticFiles
 from fastapi.testclient import TestClient
+from starlette.datastructures import Headers, MutableHeaders
+from time import perf_counter
+from collections import Counter, OrderedDict, deque
+from contextvars import ContextVar
+
+from contextlib import asynccontextmanager
 
 # environment variables
-from functools import lru_cache
+from functools import lru_cache, wraps
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -46,7 +61,16 @@ You will be able to:
 * **Create users** (_not implemented_).
 * **Read users** (_not implemented_).
 """
+# Lifespan: runs before the app takes requests and after it stops (see Lifespan Events below)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    session_sweeper = asyncio.create_task(sweep_sessions())
+    yield
+    session_sweeper.cancel()
+
+
 app = FastAPI(
+    lifespan=lifespan,
     # openapi_url=None,
     openapi_tags=tags_metadata,
     title="ChimichangApp",
@@ -66,14 +90,333 @@ app = FastAPI(
     },
 )
 
-@app.middleware("http")
-async def add_process_time_header(request: Request, call_next):
-    from time import time
-    start_time = time()
-    response = await call_next(request)
-    process_time = time() - start_time
-    response.headers["X-Process-Time"] = str(process_time)
-    return response
+# Middleware
+"""
+@app.middleware("http") is a BaseHTTPMiddleware: it runs call_next in another task and passes the body
+through a memory stream, which slows every response and breaks streaming (uploads, static files, long responses).
+
+A pure ASGI middleware is just a class with __call__(scope, receive, send).
+It adds the header to the "http.response.start" message and lets the body go straight through.
+
+# @app.middleware("http")
+# async def add_process_time_header(request: Request, call_next):
+#     from time import time
+#     start_time = time()
+#     response = await call_next(request)
+#     process_time = time() - start_time
+#     response.headers["X-Process-Time"] = str(process_time)
+#     return response
+
+Run bench_middleware.py to see the cost of each layer.
+"""
+class ProcessTimeMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = perf_counter()
+
+        async def send_with_process_time(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers.append("X-Process-Time", str(perf_counter() - start_time))
+            await send(message)
+
+        await self.app(scope, receive, send_with_process_time)
+
+
+app.add_middleware(ProcessTimeMiddleware)
+
+
+# Request trace
+"""
+Send "X-Trace: 1" with the admin "X-Token" and "X-Key" and the response gets a Server-Timing header
+(the browser devtools show it) with the time spent in each phase of the request:
+routing, dependencies, validation, handler, serialization and the total.
+The last traces are also kept for GET /admin/traces.
+
+FastAPI has no hooks for these phases, so install_tracing() wraps the (private) functions that FastAPI calls
+for each of them. It is done once, for the whole process, when TraceMiddleware is created.
+When the request is not traced the wrappers only read a ContextVar.
+"""
+import fastapi.dependencies.utils
+import fastapi.routing
+from fastapi.routing import APIRoute
+from inspect import iscoroutinefunction
+
+ADMIN_TOKEN = "fake-super-secret-token"
+ADMIN_KEY = "fake-super-secret-key"
+TRACE_PHASES = ["routing", "dependencies", "validation", "handler", "serialization"]
+current_trace: ContextVar[dict | None] = ContextVar("current_trace", default=None)
+recent_traces: deque[dict] = deque(maxlen=100)
+
+
+class TraceMiddleware:
+    def __init__(self, app):
+        self.app = app
+        install_tracing()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        if headers.get("x-trace") != "1" or headers.get("x-token") != ADMIN_TOKEN or headers.get("x-key") != ADMIN_KEY:
+            await self.app(scope, receive, send)
+            return
+
+        trace = {"start": perf_counter()}
+        token = current_trace.set(trace)
+
+        async def send_with_trace(message):
+            if message["type"] == "http.response.start":
+                total = perf_counter() - trace["start"]
+                # validation happens inside the dependency resolution, so it is taken out of it
+                trace["dependencies"] = trace.get("dependencies", 0) - trace.get("validation", 0)
+                timings = {phase: trace.get(phase, 0) * 1000 for phase in TRACE_PHASES}
+                timings["total"] = total * 1000
+                recent_traces.append({"method": scope["method"], "path": scope["path"], "ms": timings})
+                MutableHeaders(scope=message).append("Server-Timing", ", ".join(f"{phase};dur={ms:.3f}" for phase, ms in timings.items()))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            current_trace.reset(token)
+
+
+def traced(phase: str, func):
+    if iscoroutinefunction(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            trace = current_trace.get()
+            if trace is None:
+                return await func(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                trace[phase] = trace.get(phase, 0) + perf_counter() - start
+    else:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = current_trace.get()
+            if trace is None:
+                return func(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                trace[phase] = trace.get(phase, 0) + perf_counter() - start
+    return wrapper
+
+
+# (module, function, phase): only the solve_dependencies of fastapi.routing is wrapped,
+# the sub-dependencies are resolved inside it
+TRACE_HOOKS = [
+    (fastapi.routing, "solve_dependencies", "dependencies"),
+    (fastapi.dependencies.utils, "request_params_to_args", "validation"),
+    (fastapi.dependencies.utils, "request_body_to_args", "validation"),
+    (fastapi.routing, "run_endpoint_function", "handler"),
+    (fastapi.routing, "serialize_response", "serialization"),
+]
+tracing_installed = False
+
+
+def install_tracing():
+    global tracing_installed
+    if tracing_installed:
+        return
+    for module, name, phase in TRACE_HOOKS:
+        setattr(module, name, traced(phase, getattr(module, name)))
+
+    route_handle = APIRoute.handle
+
+    async def traced_route_handle(self, scope, receive, send):
+        # the route was found: everything since the start of the request was routing (and the inner middleware)
+        trace = current_trace.get()
+        if trace is not None and "routing" not in trace:
+            trace["routing"] = perf_counter() - trace["start"]
+        await route_handle(self, scope, receive, send)
+
+    APIRoute.handle = traced_route_handle
+    tracing_installed = True
+
+
+app.add_middleware(TraceMiddleware)
+
+
+
+
+# Sessions
+"""
+Server-side sessions: the cookie holds only the signed session id (itsdangerous), the data stays on the server
+in a backend. The backends follow the SessionBackend interface of fastapi-sessions:
+
+- LRUSessionBackend: in memory, keeps at most max_sessions, the least recently used are dropped first.
+- SQLiteSessionBackend: in a SQLite file, survives a restart.
+
+request.session is a plain dict. The session is written (and the cookie sent) only when the handler changed it,
+so a request that only reads the session costs one backend read, and a request without a cookie costs nothing.
+On a websocket the session is read-only: a change made there is not saved.
+Expired sessions are removed by a background task, started by the lifespan handler (see lifespan).
+"""
+from fastapi_sessions.backends.session_backend import SessionBackend
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import HTTPConnection
+from copy import deepcopy
+import sqlite3
+import threading
+from time import time as now
+from uuid import uuid4
+
+SESSION_COOKIE = "session_id"
+SESSION_SECRET_KEY = "fake-super-secret-session-key"
+SESSION_MAX_AGE = 14 * 24 * 60 * 60  # 14 days
+SESSION_SWEEP_INTERVAL = 60
+
+
+class LRUSessionBackend(SessionBackend[UUID, dict]):
+    def __init__(self, max_sessions: int = 10_000, max_age: int = SESSION_MAX_AGE):
+        self.max_sessions = max_sessions
+        self.max_age = max_age
+        self.sessions: OrderedDict[UUID, tuple[float, dict]] = OrderedDict()
+
+    async def create(self, session_id: UUID, data: dict) -> None:
+        await self.update(session_id, data)
+
+    async def read(self, session_id: UUID) -> dict | None:
+        expires_at, data = self.sessions.get(session_id, (0, None))
+        if expires_at < now():
+            return None
+        self.sessions.move_to_end(session_id)
+        return data
+
+    async def update(self, session_id: UUID, data: dict) -> None:
+        self.sessions[session_id] = (now() + self.max_age, deepcopy(data))
+        self.sessions.move_to_end(session_id)
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+    async def delete(self, session_id: UUID) -> None:
+        self.sessions.pop(session_id, None)
+
+    async def sweep(self) -> None:
+        expired = [session_id for session_id, (expires_at, _) in self.sessions.items() if expires_at < now()]
+        for session_id in expired:
+            del self.sessions[session_id]
+
+
+class SQLiteSessionBackend(SessionBackend[UUID, dict]):
+    def __init__(self, path: str = "sessions.db", max_age: int = SESSION_MAX_AGE):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)")
+
+    def execute(self, sql: str, *params):
+        # sqlite3 is blocking, so it runs in the threadpool and one query at a time
+        def run():
+            with self.lock:
+                return self.connection.execute(sql, params).fetchone()
+        return run_in_threadpool(run)
+
+    async def create(self, session_id: UUID, data: dict) -> None:
+        await self.update(session_id, data)
+
+    async def read(self, session_id: UUID) -> dict | None:
+        row = await self.execute("SELECT data FROM sessions WHERE id = ? AND expires_at >= ?", session_id.hex, now())
+        return json.loads(row[0]) if row else None
+
+    async def update(self, session_id: UUID, data: dict) -> None:
+        await self.execute("INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)", session_id.hex, json.dumps(data), now() + self.max_age)
+
+    async def delete(self, session_id: UUID) -> None:
+        await self.execute("DELETE FROM sessions WHERE id = ?", session_id.hex)
+
+    async def sweep(self) -> None:
+        await self.execute("DELETE FROM sessions WHERE expires_at < ?", now())
+
+
+session_backend = LRUSessionBackend()
+# session_backend = SQLiteSessionBackend("sessions.db")
+
+
+class ServerSessionMiddleware:
+    def __init__(self, app, backend: SessionBackend, secret_key: str, cookie_name: str = SESSION_COOKIE, max_age: int = SESSION_MAX_AGE, https_only: bool = False):
+        self.app = app
+        self.backend = backend
+        self.cookie_name = cookie_name
+        self.max_age = max_age
+        self.signer = URLSafeTimedSerializer(secret_key, salt=cookie_name)
+        self.security_flags = "httponly; samesite=lax" + ("; secure" if https_only else "")
+        # checking the signature is the slowest part of a request with a session, a browser sends the same cookie every time
+        self.verified_cookie = lru_cache(maxsize=4096)(self.verify_cookie)
+
+    def verify_cookie(self, signed_session_id: str) -> tuple[UUID, float] | None:
+        try:
+            session_id, signed_at = self.signer.loads(signed_session_id, return_timestamp=True)
+            return UUID(session_id), signed_at.timestamp()
+        except (BadSignature, ValueError):
+            return None
+
+    def load_session_id(self, scope) -> UUID | None:
+        signed_session_id = HTTPConnection(scope).cookies.get(self.cookie_name)
+        if not signed_session_id:
+            return None
+        verified = self.verified_cookie(signed_session_id)
+        if verified is None or now() - verified[1] > self.max_age:
+            return None
+        return verified[0]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        session_id = self.load_session_id(scope)
+        loaded = await self.backend.read(session_id) if session_id else None
+        if loaded is None:
+            session_id = None
+        # the backends return their own copy, so it stays untouched and is compared at the end;
+        # the handler gets a deep copy, so a change inside a nested value (session["cart"].append(...)) is seen too
+        original = loaded or {}
+        scope["session"] = deepcopy(loaded) if loaded else {}
+
+        async def send_with_session(message):
+            nonlocal session_id
+            if message["type"] == "http.response.start" and scope["session"] != original:
+                headers = MutableHeaders(scope=message)
+                if scope["session"]:
+                    if session_id is None:
+                        session_id = uuid4()
+                        await self.backend.create(session_id, scope["session"])
+                    else:
+                        await self.backend.update(session_id, scope["session"])
+                    value = self.signer.dumps(session_id.hex)
+                    headers.append("Set-Cookie", f"{self.cookie_name}={value}; path=/; Max-Age={self.max_age}; {self.security_flags}")
+                elif session_id is not None:
+                    await self.backend.delete(session_id)
+                    headers.append("Set-Cookie", f"{self.cookie_name}=null; path=/; expires=Thu, 01 Jan 1970 00:00:00 GMT; {self.security_flags}")
+            await send(message)
+
+        await self.app(scope, receive, send_with_session)
+
+
+app.add_middleware(ServerSessionMiddleware, backend=session_backend, secret_key=SESSION_SECRET_KEY)
+
+
+async def sweep_sessions():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        await session_backend.sweep()
 
 
 
@@ -91,8 +434,48 @@ max_age - Sets a maximum time in seconds for browsers to cache CORS responses. D
 allow_credentials - Indicate that cookies should be supported for cross-origin requests. 
 Defaults to False. Also, allow_origins cannot be set to ['*'] for credentials to be allowed, origins must be specified.
 """
+
+# Cached CORS preflight
+"""
+Every OPTIONS preflight builds the same answer again and again. A browser sends the same
+(origin, method, headers) triple for every call of a page, so we build the response once
+and keep it in an LRU cache (the same lru_cache we use for the settings).
+
+The origins are kept in a frozenset (or a compiled regex with allow_origin_regex), so checking
+an origin is O(1) instead of a scan over the list.
+
+max_age is raised to 7200 seconds: Chromium caps Access-Control-Max-Age at 2 hours, so a bigger
+value is useless, and the default 600 makes the browser preflight again every 10 minutes.
+
+This middleware is added last, so it is the outermost one and answers the preflight before
+any other middleware runs.
+"""
+class CachedCORSMiddleware(CORSMiddleware):
+    def __init__(self, app, preflight_cache_size: int = 1024, max_age: int = 7200, **kwargs):
+        super().__init__(app, max_age=max_age, **kwargs)
+        self.allow_origins = frozenset(self.allow_origins)
+        self.cached_preflight = lru_cache(maxsize=preflight_cache_size)(self.build_preflight)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "OPTIONS":
+            headers = Headers(scope=scope)
+            origin = headers.get("origin")
+            method = headers.get("access-control-request-method")
+            if origin is not None and method is not None:
+                response = self.cached_preflight(origin, method, headers.get("access-control-request-headers"))
+                await response(scope, receive, send)
+                return
+        await super().__call__(scope, receive, send)
+
+    def build_preflight(self, origin: str, method: str, requested_headers: str | None):
+        raw = [(b"origin", origin.encode("latin-1")), (b"access-control-request-method", method.encode("latin-1"))]
+        if requested_headers is not None:
+            raw.append((b"access-control-request-headers", requested_headers.encode("latin-1")))
+        return self.preflight_response(request_headers=Headers(raw=raw))
+
+
 app.add_middleware(
-    CORSMiddleware,
+    CachedCORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
@@ -104,6 +487,145 @@ app.add_middleware(
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
+# Request coalescing (single-flight)
+"""
+When many identical requests arrive together, only the first one runs the handler,
+the others wait for its result instead of hitting the store again.
+
+@single_flight() goes under the route decorator of an async handler. The key is the handler itself plus its arguments,
+pass key=... to choose which arguments make two requests "the same".
+- Arguments that can't be hashed (a list query, a body model, a dict dependency) are compared by their JSON.
+- Request, Response and BackgroundTasks arguments are left out of the key: the handler runs once,
+  with the first request's objects, so headers or tasks it adds reach only the first request.
+An error of the handler is raised in every waiting request.
+timeout limits only how long a duplicate waits for the running call (then it gets 504),
+the request that runs the handler is never cut short.
+The counters and the timeout are in GET /single_flight/stats.
+"""
+def single_flight_key(kwargs: dict) -> tuple:
+    parts = []
+    for name, value in sorted(kwargs.items()):
+        if isinstance(value, (HTTPConnection, Response, BackgroundTasks)):
+            continue
+        try:
+            hash(value)
+        except TypeError:
+            value = json.dumps(jsonable_encoder(value), sort_keys=True)
+        parts.append((name, value))
+    return tuple(parts)
+
+
+class SingleFlight:
+    def __init__(self, timeout: float | None = 10):
+        self.timeout = timeout
+        self.calls: dict[Any, asyncio.Task] = {}
+        self.stats = {"calls": 0, "coalesced": 0, "errors": 0, "timeouts": 0}
+
+    async def do(self, key, call):
+        self.stats["calls"] += 1
+        task = self.calls.get(key)
+        if task is None:
+            # the handler runs in its own task, so a client that disconnects doesn't cancel it for the others
+            task = asyncio.ensure_future(call())
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())
+            waiting = asyncio.shield(task)
+        else:
+            self.stats["coalesced"] += 1
+            waiting = asyncio.wait_for(asyncio.shield(task), self.timeout)
+        try:
+            return await waiting
+        except asyncio.TimeoutError:
+            if task.done():  # the handler itself raised TimeoutError
+                self.stats["errors"] += 1
+                raise
+            self.stats["timeouts"] += 1
+            raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail="Timed out waiting for the response")
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+
+    def __call__(self, key=None):
+        def decorator(func):
+            if not iscoroutinefunction(func):
+                raise TypeError(f"single_flight needs an async handler, {func.__qualname__} is not")
+
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                # the function object, not its name: this file declares several handlers with the same name
+                call_key = (func, key(**kwargs) if key else single_flight_key(kwargs))
+                return await self.do(call_key, lambda: func(*args, **kwargs))
+            return wrapper
+        return decorator
+
+
+single_flight = SingleFlight()
+
+
+def test_single_flight():
+    group = SingleFlight()
+    calls = []
+
+    @group()
+    async def load(item_id: str):
+        calls.append(item_id)
+        await asyncio.sleep(0.01)
+        if item_id == "missing":
+            raise KeyError(item_id)
+        return {"item_id": item_id}
+
+    async def run():
+        results = await asyncio.gather(*[load(item_id="foo") for _ in range(5)], load(item_id="bar"))
+        errors = await asyncio.gather(load(item_id="missing"), load(item_id="missing"), return_exceptions=True)
+        return results, errors
+
+    results, errors = asyncio.run(run())
+    assert results == [{"item_id": "foo"}] * 5 + [{"item_id": "bar"}]
+    assert calls == ["foo", "bar", "missing"]
+    assert all(isinstance(error, KeyError) for error in errors)
+    assert group.stats == {"calls": 8, "coalesced": 5, "errors": 2, "timeouts": 0}
+
+    @group()
+    async def search(q: list[str], request: Request):
+        calls.append(q)
+        return q
+
+    async def run_search():
+        return await asyncio.gather(search(q=["a", "b"], request=Request({"type": "http"})), search(q=["a", "b"], request=Request({"type": "http"})))
+
+    assert asyncio.run(run_search()) == [["a", "b"], ["a", "b"]]
+    assert calls[-1] == ["a", "b"] and calls.count(["a", "b"]) == 1
+
+    slow_group = SingleFlight(timeout=0.01)
+
+    @slow_group()
+    async def slow():
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def run_slow():
+        return await asyncio.gather(slow(), slow(), return_exceptions=True)
+
+    # the first request runs the handler to the end, only the duplicate gives up
+    first, duplicate = asyncio.run(run_slow())
+    assert first == "done"
+    assert isinstance(duplicate, HTTPException) and duplicate.status_code == 504
+    assert slow_group.stats["timeouts"] == 1
+
+    try:
+        group()(lambda: {})
+        assert False, "sync handler accepted"
+    except TypeError:
+        pass
+    assert client.get("/model/lenet").json()["model_name"] == "lenet"
+
+
+@app.get("/single_flight/stats")
+async def read_single_flight_stats():
+    return {**single_flight.stats, "in_flight": len(single_flight.calls), "duplicate_timeout": single_flight.timeout}
+
+
 # Test
 client = TestClient(app)
 
@@ -120,12 +642,141 @@ def test_read_root():
     assert response.json() == {"Hello": "World"}
 
 
+def test_process_time_header():
+    response = client.get("/")
+    assert float(response.headers["x-process-time"]) >= 0
+
+
+def test_cors_preflight():
+    headers = {"Origin": "http://localhost", "Access-Control-Request-Method": "PUT", "Access-Control-Request-Headers": "x-token"}
+    response = client.options("/items/1", headers=headers)
+    assert response.status_code == 200
+    assert response.headers["access-control-allow-origin"] == "http://localhost"
+    assert response.headers["access-control-max-age"] == "7200"
+    assert "x-process-time" not in response.headers
+    response = client.options("/items/1", headers={**headers, "Origin": "http://evil.com"})
+    assert response.status_code == 400
+
+
 # this will override the '/items/{item_id}' route
 # just of this specific route otherwire the second route will be used
 @app.get("/items/favorite", tags=["items"])
 async def read_item():
     return {"item": "override"}
 
+
+# Streaming export
+"""
+Streams the whole 'items' store as NDJSON or CSV, so the client doesn't have to read the items one by one.
+
+- The rows are written in chunks of EXPORT_CHUNK_SIZE bytes, so memory stays flat however big the store is,
+  and StreamingResponse waits for each chunk to be sent before asking for the next one.
+- The first rows are sent as soon as they are ready, so the first byte arrives fast.
+- With "Accept-Encoding: gzip" the chunks are compressed on the fly.
+- If the client disconnects, StreamingResponse cancels the generator, so we stop producing rows.
+- The rows are sorted by "id". To resume a broken export send the last id you got as ?cursor=...
+  and the export goes on with the ids after it (the item doesn't have to exist anymore).
+  A resumed CSV export has no header row.
+
+It must be declared before '/items/{item_id}', otherwise "export" is taken as an item_id.
+"""
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_FIELDS = ["id", "name", "description", "price", "tax", "tags"]
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+def export_row(item_id: str, item: dict, export_format: ExportFormat) -> str:
+    row = {"id": item_id, **item}
+    if export_format == ExportFormat.ndjson:
+        return json.dumps(row, default=list) + "\n"
+    buffer = io.StringIO()
+    csv.DictWriter(buffer, EXPORT_FIELDS, extrasaction="ignore").writerow(
+        {**row, "tags": " ".join(row.get("tags") or [])}
+    )
+    return buffer.getvalue()
+
+
+async def export_items(export_format: ExportFormat, cursor: str | None, compress: bool):
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31 writes the gzip header
+    # only the keys are copied: the store may change while we are streaming
+    item_ids = sorted(items)
+    start = bisect_right(item_ids, cursor) if cursor is not None else 0
+
+    chunk = []
+    size = 0
+    first_row_sent = False
+    if export_format == ExportFormat.csv and cursor is None:
+        chunk.append(",".join(EXPORT_FIELDS) + "\r\n")
+    for position in range(start, len(item_ids)):
+        item = items.get(item_ids[position])
+        if item is None:  # deleted while we were streaming
+            continue
+        row = export_row(item_ids[position], item, export_format)
+        chunk.append(row)
+        size += len(row)
+        # the first row goes out alone, so the client gets its first byte fast
+        if size >= EXPORT_CHUNK_SIZE or not first_row_sent:
+            first_row_sent = True
+            data = "".join(chunk).encode()
+            yield compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH) if compressor else data
+            chunk = []
+            size = 0
+            await asyncio.sleep(0)  # let the other requests run between chunks
+    data = "".join(chunk).encode()
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+
+def accepts_gzip(accept_encoding: str | None) -> bool:
+    # "gzip;q=0" means "not gzip", and "*" counts only when gzip is not named
+    qualities = {}
+    for coding in (accept_encoding or "").split(","):
+        name, _, params = coding.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.strip().lower()] = quality
+    quality = qualities.get("gzip", qualities.get("x-gzip", qualities.get("*", 0.0)))
+    return quality > 0
+
+
+@app.get("/items/export", tags=["items"])
+async def export_items_stream(
+    export_format: Annotated[ExportFormat, Query(alias="format")] = ExportFormat.ndjson,
+    cursor: str | None = None,
+    accept_encoding: Annotated[str | None, Header()] = None,
+):
+    compress = accepts_gzip(accept_encoding)
+    headers = {"Content-Encoding": "gzip", "Vary": "Accept-Encoding"} if compress else {"Vary": "Accept-Encoding"}
+    media_type = "application/x-ndjson" if export_format == ExportFormat.ndjson else "text/csv"
+    return StreamingResponse(export_items(export_format, cursor, compress), media_type=media_type, headers=headers)
+
+
+
+def test_export_items():
+    response = client.get("/items/export", params={"format": "csv", "cursor": "bar"}, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.text == "baz,Baz,,50.2,10.5,\r\nfoo,Foo,,50.2,,\r\n"
+    # the cursor doesn't have to be an existing item
+    assert client.get("/items/export", params={"format": "csv", "cursor": "bazz"}).text == "foo,Foo,,50.2,,\r\n"
+    response = client.get("/items/export", headers={"Accept-Encoding": "gzip;q=0, deflate"})
+    assert "content-encoding" not in response.headers
+    lines = response.text.splitlines()
+    assert accepts_gzip("br, *;q=0.1") and not accepts_gzip("*, gzip;q=0") and not accepts_gzip(None)
+    assert [json.loads(line)["id"] for line in lines] == ["bar", "baz", "foo"]
+
+
 # bool: can be true, True, yes, 1 or on
 @app.get("/items/{item_id}")
 async def read_item(item_id: str, query_param_optional: bool | None = None):
@@ -146,6 +797,7 @@ class CNNModel(str, Enum):
    
 
 @app.get("/model/{model_name}")
+@single_flight()
 async def get_model(model_name: CNNModel):
     if model_name == CNNModel.resnet:
         return {"model_name": model_name, "message": "Deep Residual Learning for Image Recognition"}
@@ -321,8 +973,19 @@ items = {
     "baz": {"name": "Baz", "description": None, "price": 50.2, "tax": 10.5, "tags": []},
 }
 
+# ETag: every write of an item increases its version, the ETag is the version
+item_versions: dict[str, int] = {}
+
+def item_etag(item_id: str) -> str:
+    return f'"{item_versions.get(item_id, 1)}"'
+
+async def set_item_etag(item_id: str, response: Response):
+    if item_id in items:
+        response.headers["ETag"] = item_etag(item_id)
+
 # response_model_exclude_unset: exclude the fields that are not set
-@app.get("/get_items/{item_id}", response_model=Item, response_model_exclude_unset=True)
+@app.get("/get_items/{item_id}", response_model=Item, response_model_exclude_unset=True, dependencies=[Depends(set_item_etag)])
+@single_flight()
 async def read_items(item_id: str):
     return items[item_id]
 
@@ -453,19 +1116,118 @@ async def update_item(item_id: str, item: Item):
 
 # put and patch
 # exp: "baz": {"name": "Baz", "description": None, "price": 50.2, "tax": 10.5, "tags": []},
+"""
+PUT replaces the whole item, PATCH only changes the fields that were sent (exclude_unset).
+
+If-Match: send the ETag you got from GET /get_items/{item_id} (or a previous PUT/PATCH),
+if somebody changed the item in the meantime the write is refused with 412 instead of overwriting their change.
+
+Idempotency-Key: a retry with the same key gets the stored response back without writing again.
+The same key with another body is refused with 422. Only the last IDEMPOTENCY_CACHE_SIZE keys are kept.
+"""
+IDEMPOTENCY_CACHE_SIZE = 1024
+idempotency_cache: OrderedDict[tuple[str, str, str], tuple[str, Any, str]] = OrderedDict()
+
+
+def replay_idempotent(key: tuple[str, str, str] | None, fingerprint: str) -> JSONResponse | None:
+    if key is None or key not in idempotency_cache:
+        return None
+    idempotency_cache.move_to_end(key)
+    stored_fingerprint, content, etag = idempotency_cache[key]
+    if stored_fingerprint != fingerprint:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Idempotency-Key reused with a different request")
+    return JSONResponse(content=content, headers={"ETag": etag, "Idempotent-Replayed": "true"})
+
+
+def remember_idempotent(key: tuple[str, str, str] | None, fingerprint: str, content: Any, etag: str):
+    if key is None:
+        return
+    idempotency_cache[key] = (fingerprint, content, etag)
+    if len(idempotency_cache) > IDEMPOTENCY_CACHE_SIZE:
+        idempotency_cache.popitem(last=False)
+
+
+def check_if_match(item_id: str, if_match: str | None):
+    if if_match is None:
+        return
+    if item_id in items:
+        # If-Match uses the strong comparison: a weak tag (W/"2") never matches
+        etags = {etag.strip() for etag in if_match.split(",")}
+        if "*" in etags or item_etag(item_id) in etags:
+            return
+    raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Item was changed, get it again")
+
+
+def save_item(item_id: str, item_encoded: dict, response: Response) -> str:
+    item_versions[item_id] = item_versions.get(item_id, 1) + 1 if item_id in items else 1
+    items[item_id] = item_encoded
+    etag = item_etag(item_id)
+    response.headers["ETag"] = etag
+    return etag
+
+
 @app.put("/put/{item_id}")
-async def update_item(item_id: str, item: Item):
+async def update_item(item_id: str, item: Item, response: Response, if_match: Annotated[str | None, Header()] = None, idempotency_key: Annotated[str | None, Header()] = None):
+    key = ("PUT", item_id, idempotency_key) if idempotency_key else None
+    fingerprint = item.model_dump_json()
+    replayed = replay_idempotent(key, fingerprint)
+    if replayed:
+        return replayed
+    check_if_match(item_id, if_match)
     update_item_encoded = jsonable_encoder(item)
-    items[item_id] = update_item_encoded
+    etag = save_item(item_id, update_item_encoded, response)
+    remember_idempotent(key, fingerprint, update_item_encoded, etag)
     return update_item_encoded
 
+
+class ItemPatch(BaseModel):
+    name: str | None = None
+    description: str | None = Field(default=None, max_length=300)
+    price: float | None = Field(default=None, gt=0)
+    tax: float | None = None
+    tags: set[str] | None = None
+    image: Image | None = None
+
+
 @app.patch("/patch/{item_id}")
-async def patch_item(item_id: str, item: Item):
-    update_item_encoded = jsonable_encoder(item)
-    items[item_id] = update_item_encoded
+async def patch_item(item_id: str, item: ItemPatch, response: Response, if_match: Annotated[str | None, Header()] = None, idempotency_key: Annotated[str | None, Header()] = None):
+    key = ("PATCH", item_id, idempotency_key) if idempotency_key else None
+    fingerprint = item.model_dump_json(exclude_unset=True)
+    replayed = replay_idempotent(key, fingerprint)
+    if replayed:
+        return replayed
+    if item_id not in items:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Item not found")
+    check_if_match(item_id, if_match)
+    # merge only the fields that were sent, then validate the whole item again
+    stored_item = Item(**items[item_id])
+    try:
+        updated_item = Item.model_validate({**stored_item.model_dump(), **item.model_dump(exclude_unset=True)})
+    except ValidationError as exc:
+        errors = [{**error, "loc": ("body", *error["loc"])} for error in exc.errors(include_url=False)]
+        raise RequestValidationError(errors, body=item.model_dump(exclude_unset=True))
+    update_item_encoded = jsonable_encoder(updated_item)
+    etag = save_item(item_id, update_item_encoded, response)
+    remember_idempotent(key, fingerprint, update_item_encoded, etag)
     return update_item_encoded
 
 
+def test_conditional_and_idempotent_updates():
+    response = client.put("/put/qux", json={"name": "Qux", "price": 10}, headers={"Idempotency-Key": "qux-1"})
+    assert response.headers["etag"] == '"1"'
+    replayed = client.put("/put/qux", json={"name": "Qux", "price": 10}, headers={"Idempotency-Key": "qux-1"})
+    assert replayed.headers["idempotent-replayed"] == "true"
+    assert item_versions["qux"] == 1
+    response = client.patch("/patch/qux", json={"tax": 2}, headers={"If-Match": '"1"'})
+    assert response.json()["name"] == "Qux" and response.json()["tax"] == 2
+    assert response.headers["etag"] == '"2"'
+    assert client.patch("/patch/qux", json={"tax": 3}, headers={"If-Match": '"1"'}).status_code == 412
+    assert client.patch("/patch/qux", json={"tax": 3}, headers={"If-Match": 'W/"2"'}).status_code == 412
+    assert client.patch("/patch/qux", json={"price": None}).status_code == 422
+    items.pop("qux")
+    item_versions.pop("qux")
+
+
 
 # SLEEP
 
@@ -538,9 +1300,11 @@ async def read_dependency3(item_params: Annotated[ItemParams, Depends()]):
 async def query_extractor(q: str | None = None):
     return q
 
-async def query_or_cookie_extractor(q: Annotated[str, Depends(query_extractor)], last_query: Annotated[str | None, Cookie()] = None):
+# the last query is kept in the session (see Sessions), not in a raw cookie
+async def query_or_cookie_extractor(request: Request, q: Annotated[str, Depends(query_extractor)]):
     if not q:
-        return last_query
+        return request.session.get("last_query")
+    request.session["last_query"] = q
     return q
 
 @app.get("/dependency4/")
@@ -548,15 +1312,39 @@ async def read_dependency4(query_or_default: str = Depends(query_or_cookie_extra
     return {"q_or_cookie": query_or_default}
 
 
+def test_query_or_session():
+    session_client = TestClient(app)
+    response = session_client.get("/dependency4/", params={"q": "rock"})
+    assert SESSION_COOKIE in response.cookies
+    response = session_client.get("/dependency4/")
+    assert response.json() == {"q_or_cookie": "rock"}
+    assert "set-cookie" not in response.headers  # nothing changed, nothing written
+    assert TestClient(app).get("/dependency4/").json() == {"q_or_cookie": None}
+
+
+def test_session_nested_changes():
+    async def add_to_cart(scope, receive, send):
+        scope["session"].setdefault("cart", []).append(Request(scope).query_params["item"])
+        await JSONResponse(scope["session"]["cart"])(scope, receive, send)
+
+    for backend in (LRUSessionBackend(), SQLiteSessionBackend(":memory:")):
+        session_client = TestClient(ServerSessionMiddleware(add_to_cart, backend=backend, secret_key=SESSION_SECRET_KEY))
+        assert session_client.get("/", params={"item": "a"}).json() == ["a"]
+        response = session_client.get("/", params={"item": "b"})
+        assert response.json() == ["a", "b"]
+        assert SESSION_COOKIE in response.cookies
+    assert session_client.get("/", params={"item": "c"}).json() == ["a", "b", "c"]
+
+
 # Dependencies in path operation decorators
 
 async def verify_token(x_token: Annotated[str, Header()]):
-    if x_token != "fake-super-secret-token":
+    if x_token != ADMIN_TOKEN:
         raise HTTPException(status_code=400, detail="X-Token header invalid")
 
 
 async def verify_key(x_key: Annotated[str, Header()]):
-    if x_key != "fake-super-secret-key":
+    if x_key != ADMIN_KEY:
         raise HTTPException(status_code=400, detail="X-Key header invalid")
     return x_key
 
@@ -726,6 +1514,17 @@ async def websocket_endpoint(websocket: WebSocket):
         await websocket.send_text(f"Message text was: {data}")
 
 
+def test_websocket_echo():
+    from starlette.websockets import WebSocketDisconnect
+    # the endpoint loops until the client leaves, so closing the socket ends it with WebSocketDisconnect
+    try:
+        with client.websocket_connect("/ws") as websocket:
+            websocket.send_text("hello")
+            assert websocket.receive_text() == "Message text was: hello"
+    except WebSocketDisconnect:
+        pass
+
+
 # Test websockets
 # @app.websocket("/ws")
 # async def websocket(websocket: WebSocket):
@@ -828,7 +1627,339 @@ def get_settings():
 
 
 @app.get("/info")
+@single_flight(key=lambda settings: settings.KEY)
 async def info(settings: Annotated[Settings, Depends(get_settings)]):
     return {
         "app_name": settings.KEY,
-    }
\ No newline at end of file
+    }
+
+
+# Route index
+"""
+Starlette finds the route with a linear scan: it tries the regex of every route, in the order they were declared.
+With hundreds of routes every request pays for all of them.
+
+RouteIndex puts the routes in a prefix tree keyed by the literal path segments and the method,
+so a request only tries the few routes that can match its path.
+The order is kept: the candidates are still checked in declaration order, so the result is the same as the linear scan.
+If nothing matches (404, 405, redirect of the trailing slash) we fall back to the normal router.
+
+It is optional: set USE_ROUTE_INDEX (at the end of the file) or call install_route_index(app) yourself.
+When installed it also logs the routes that are shadowed by an earlier route
+(like '/items/{item_id}' by '/items/favorite') and the routes that can never be reached.
+"""
+from starlette.convertors import CONVERTOR_TYPES
+from starlette.routing import Host, Match, Mount, Route, WebSocketRoute
+import logging
+
+
+def parse_segment(segment: str):
+    if "{" not in segment:
+        return ("literal", segment)
+    if segment.endswith(":path}"):
+        return ("path", None)
+    if segment.startswith("{") and segment.endswith("}") and segment.count("{") == 1:
+        return ("param", segment[1:-1].partition(":")[2] or "str")
+    return ("mixed", segment)
+
+
+def parse_route(route):
+    segments = [parse_segment(segment) for segment in route.path.split("/")[1:]]
+    if isinstance(route, Mount):
+        segments = [segment for segment in segments if segment != ("literal", "")] + [("path", None)]
+    return segments
+
+
+def route_methods(route):
+    return getattr(route, "methods", None) or None
+
+
+def route_kind(route):
+    if isinstance(route, Mount):
+        return None
+    return "websocket" if isinstance(route, WebSocketRoute) else "http"
+
+
+class RouteNode:
+    def __init__(self):
+        self.children = {}
+        self.param = None
+        self.routes = {}
+        self.wildcard = {}
+
+
+class RouteIndex:
+    def __init__(self, router):
+        self.router = router
+        self.root = RouteNode()
+        self.always = []
+        for index, route in enumerate(router.routes):
+            self.add(index, route)
+
+    def add(self, index, route):
+        if isinstance(route, Host) or not hasattr(route, "path"):
+            self.always.append((index, route))
+            return
+        node = self.root
+        for kind, value in parse_route(route):
+            if kind == "path":
+                table = node.wildcard
+                break
+            if kind == "literal":
+                node = node.children.setdefault(value, RouteNode())
+            else:
+                node.param = node.param or RouteNode()
+                node = node.param
+        else:
+            table = node.routes
+        for method in route_methods(route) or [None]:
+            table.setdefault(method, []).append((index, route))
+
+    def candidates(self, node, segments, position, keys, found):
+        for key in keys:
+            found.extend(node.wildcard.get(key, ()))
+        if position == len(segments):
+            for key in keys:
+                found.extend(node.routes.get(key, ()))
+            return
+        child = node.children.get(segments[position])
+        if child is not None:
+            self.candidates(child, segments, position + 1, keys, found)
+        if node.param is not None:
+            self.candidates(node.param, segments, position + 1, keys, found)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.router.app(scope, receive, send)
+            return
+
+        path = scope["path"]
+        root_path = scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+
+        found = list(self.always)
+        # websockets have no method: only the routes without methods
+        method = scope.get("method")
+        keys = (method, None) if method is not None else (None,)
+        self.candidates(self.root, path.split("/")[1:], 0, keys, found)
+        for index, route in sorted(found, key=lambda candidate: candidate[0]):
+            match, child_scope = route.matches(scope)
+            if match == Match.FULL:
+                scope.setdefault("router", self.router)
+                scope.update(child_scope)
+                await route.handle(scope, receive, send)
+                return
+
+        await self.router.app(scope, receive, send)
+
+
+def segment_covers(a, b):
+    kind_a, value_a = a
+    kind_b, value_b = b
+    if kind_a == "literal" or kind_a == "mixed":
+        return a == b
+    if value_a == "str":
+        return kind_b != "path"
+    if kind_b == "param":
+        return value_a == value_b
+    return kind_b == "literal" and re.fullmatch(CONVERTOR_TYPES[value_a].regex, value_b) is not None
+
+
+def segment_overlaps(a, b):
+    if a[0] == "literal" and b[0] == "literal":
+        return a == b
+    if a[0] == "literal" and b[0] == "param":
+        return re.fullmatch(CONVERTOR_TYPES[b[1]].regex, a[1]) is not None
+    if a[0] == "param" and b[0] == "literal":
+        return segment_overlaps(b, a)
+    return True
+
+
+def path_relation(a, b):
+    """
+    "covers" if every path of b is also matched by a, "overlaps" if some path is matched by both, else None.
+    """
+    for position, segment in enumerate(a):
+        if segment[0] == "path":
+            # '{p:path}' comes after a "/", so b must have a segment here ("/file/{p:path}" never matches "/file")
+            if position == len(b):
+                return None
+            return "covers" if all(segment_covers(x, y) for x, y in zip(a[:position], b[:position])) else "overlaps"
+        if position == len(b):
+            return None
+        if b[position][0] == "path":
+            return "overlaps" if all(segment_overlaps(x, y) for x, y in zip(a[position:], b[position:])) else None
+        if not segment_overlaps(segment, b[position]):
+            return None
+    if len(a) != len(b):
+        return None
+    return "covers" if all(segment_covers(x, y) for x, y in zip(a, b)) else "overlaps"
+
+
+def describe_route(route):
+    methods = ",".join(sorted(route_methods(route) or ["*"]))
+    return f"{methods} {route.path} ({route.name})"
+
+
+def find_shadowed_routes(routes):
+    """
+    Returns (route, earlier_route, "unreachable" | "shadowed") for every route that an earlier route
+    takes all (unreachable) or part (shadowed) of its requests from.
+    """
+    routes = [route for route in routes if hasattr(route, "path") and not isinstance(route, Host)]
+    report = []
+    for position, route in enumerate(routes):
+        shadowed_by = None
+        for earlier in routes[:position]:
+            if route_kind(earlier) and route_kind(route) and route_kind(earlier) != route_kind(route):
+                continue
+            methods, earlier_methods = route_methods(route), route_methods(earlier)
+            if methods and earlier_methods and not methods & earlier_methods:
+                continue
+            relation = path_relation(parse_route(earlier), parse_route(route))
+            if relation == "covers" and (earlier_methods is None or (methods and methods <= earlier_methods)):
+                report.append((route, earlier, "unreachable"))
+                break
+            if relation and shadowed_by is None:
+                shadowed_by = earlier
+        else:
+            if shadowed_by is not None:
+                report.append((route, shadowed_by, "shadowed"))
+    return report
+
+
+route_index_logger = logging.getLogger("route_index")
+
+
+def install_route_index(app: FastAPI):
+    """
+    Call it after the last route is declared: routes added later are not in the index
+    (they still work, through the fallback to the normal router).
+    """
+    for route, earlier, problem in find_shadowed_routes(app.router.routes):
+        route_index_logger.warning("route %s is %s by %s", describe_route(route), problem, describe_route(earlier))
+    app.router.middleware_stack = RouteIndex(app.router)
+
+
+def test_route_index():
+    report = [(route.path, earlier.path, problem) for route, earlier, problem in find_shadowed_routes(app.router.routes)]
+    assert ("/items/{item_id}", "/items/favorite", "shadowed") in report
+
+    def problems(*paths):
+        return [(route.path, problem) for route, _, problem in find_shadowed_routes([Route(path, read_root) for path in paths])]
+
+    assert problems("/file/{p:path}", "/file") == []
+    assert problems("/{x:int}/{p:path}", "/{y}/z") == [("/{y}/z", "shadowed")]
+    assert problems("/{x}/{p:path}", "/{y:int}/z") == [("/{y:int}/z", "unreachable")]
+
+    linear_router = app.router.middleware_stack
+    install_route_index(app)
+    try:
+        assert isinstance(app.router.middleware_stack, RouteIndex)
+        assert client.get("/items/favorite").json() == {"item": "override"}
+        assert client.get("/items/5").json() == {"item_id": "5"}
+        assert client.get("/file/a/b").json() == {"file_path": "a/b"}
+        assert client.delete("/items/5").status_code == 405
+        found = []
+        app.router.middleware_stack.candidates(app.router.middleware_stack.root, ["ws"], 0, (None,), found)
+        assert [route.path for _, route in found] == ["/ws"]
+    finally:
+        app.router.middleware_stack = linear_router
+
+
+
+
+# Profiling
+"""
+Admin only (X-Token and X-Key, like /items_dep/).
+
+GET /admin/profile?seconds=10 runs a sampling profiler: a thread looks at the stack of every other thread
+every `interval` seconds and counts them. It doesn't slow the handlers down like cProfile does.
+The answer is in the "collapsed stack" format ("frame;frame;frame count" per line) that
+flamegraph.pl and https://www.speedscope.app read.
+"""
+from time import sleep as blocking_sleep
+
+
+def sample_stacks(seconds: float, interval: float) -> Counter:
+    sampler = threading.get_ident()
+    stacks = Counter()
+    end = perf_counter() + seconds
+    while perf_counter() < end:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            stacks[";".join(reversed(stack))] += 1
+        blocking_sleep(interval)
+    return stacks
+
+
+profiler_lock = asyncio.Lock()
+
+@app.get("/admin/profile", response_class=PlainTextResponse, dependencies=[Depends(verify_token), Depends(verify_key)])
+async def profile(seconds: Annotated[float, Query(gt=0, le=60)] = 10, interval: Annotated[float, Query(ge=0.001, le=1)] = 0.005):
+    if profiler_lock.locked():
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="A profile is already running")
+    async with profiler_lock:
+        # the sampler runs in the threadpool, so the event loop keeps serving (and being sampled)
+        stacks = await run_in_threadpool(sample_stacks, seconds, interval)
+    content = "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+    return PlainTextResponse(content, headers={"Content-Disposition": 'attachment; filename="profile.collapsed"'})
+
+
+@app.get("/admin/traces", dependencies=[Depends(verify_token), Depends(verify_key)])
+async def read_traces():
+    return list(recent_traces)
+
+
+def test_profiling():
+    admin = {"X-Token": ADMIN_TOKEN, "X-Key": ADMIN_KEY}
+    assert "server-timing" not in client.get("/", headers={"X-Trace": "1", "X-Token": ADMIN_TOKEN}).headers
+    response = client.put("/put/traced", json={"name": "Traced", "price": 1}, headers={"X-Trace": "1", **admin})
+    timings = dict(timing.split(";dur=") for timing in response.headers["server-timing"].split(", "))
+    assert list(timings) == TRACE_PHASES + ["total"]
+    assert float(timings["handler"]) > 0 and float(timings["validation"]) > 0
+    assert "server-timing" not in client.get("/", headers={"X-Trace": "1"}).headers
+    assert client.get("/admin/traces", headers=admin).json()[-1]["path"] == "/put/traced"
+    items.pop("traced")
+    item_versions.pop("traced")
+    response = client.get("/admin/profile", params={"seconds": 0.05}, headers=admin)
+    assert response.status_code == 200
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in response.text.splitlines())
+    assert client.get("/admin/profile", params={"seconds": 0.05}).status_code == 422
+
+
+def test_tracing_hooks():
+    # fails if a FastAPI upgrade renames or moves the private functions that install_tracing wraps
+    from types import CodeType
+
+    def called_names(code):
+        names = set(code.co_names)
+        for const in code.co_consts:
+            if isinstance(const, CodeType):
+                names |= called_names(const)
+        return names
+
+    request_handler = called_names(fastapi.routing.get_request_handler.__code__)
+    dependency_solver = called_names(fastapi.dependencies.utils.solve_dependencies.__code__)
+    for module, name, _ in TRACE_HOOKS:
+        assert callable(getattr(module, name, None)), f"{module.__name__}.{name} is gone"
+        assert name in (request_handler if module is fastapi.routing else dependency_solver), f"FastAPI doesn't call {name} anymore"
+    assert iscoroutinefunction(APIRoute.handle), "APIRoute.handle is gone"
+
+
+
+
+# Route index (optional, see Route index): installed here, after the last route
+USE_ROUTE_INDEX = False
+
+if USE_ROUTE_INDEX:
+    install_route_index(app)